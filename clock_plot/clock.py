@@ -1,111 +1,227 @@
 import warnings
+import weakref
+from types import MappingProxyType
 from typing import Union
 import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-import scipy
-
-
-def create_datetime_vars(data_in: pd.DataFrame, datetime_col: str, bins_per_day: int = 24) -> pd.DataFrame:
-    """Create all the datetime-related columns that might be used for analysis/plotting
+import scipy.interpolate
+
+_MONTH_NAMES = (
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+)
+_DAY_NAMES = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_WEEKEND_NAMES = ("Weekday", "Weekend")
+_SEASON_NAMES = ("Spring", "Summer", "Autumn", "Winter")
+_DEFAULT_CATEGORY_ORDERS = MappingProxyType(
+    {
+        "dayofweek": _DAY_NAMES,
+        "weekend": _WEEKEND_NAMES,
+        "season": _SEASON_NAMES,
+        "month": _MONTH_NAMES,
+    }
+)
+_DATETIME_COLS = (
+    "year",
+    "month",
+    "year_month",
+    "day",
+    "date",
+    "week",
+    "dayofweek",
+    "weekend",
+    "hour",
+    "minute",
+    "degrees",
+    "season",
+)
+# The datetime-related columns built by create_datetime_vars, keyed by (id of the input DataFrame, datetime_col,
+# bins_per_day). Entries are removed when the input DataFrame is garbage collected
+_DATETIME_VARS_CACHE = {}
+# Index into _SEASON_NAMES for each month number, the leading entry means month 1 (January) lands at index 1
+_SEASON_CODES = np.array([-1, 3, 3, 0, 0, 0, 1, 1, 1, 2, 2, 2, 3])
+
+
+def create_datetime_vars(
+    data_in: pd.DataFrame, datetime_col: str, bins_per_day: int = 24, needed: set = None
+) -> pd.DataFrame:
+    """Create the datetime-related columns that might be used for analysis/plotting
         columns and their possible values are:
-        year (int): Calendar year e.g. 2022
-        month (str): Calendar month e.g. "January"
-        year_month (int): Calendar year and month in the format YYYYMM e.g. 202201
-        day (int): Day of calendar year e.g. 25
+        year (int16): Calendar year e.g. 2022
+        month (category): Calendar month e.g. "January"
+        year_month (int32): Calendar year and month in the format YYYYMM e.g. 202201
+        day (int8): Day of calendar year e.g. 25
         date (str): Expressed in the format YYYY-MM-DD e.g. 2022-01-25
-        week (int): Week of the calendar year e.g. 5
-        dayofweek (str): Short version of day of week e.g. Tue
-        weekend (str): Either "weekday" or "weekend" where weekends are where dayofweek is either "Sat" or "Sun"
-        hour (int): Hour of the day in 24 clock e.g. 14
-        minute (int): Minute of the hour e.g. 42
-        degrees (int): Angle around 24 hour clock-face measured in degrees, calculated using hours and minutes
-        season (str): Season of the year defined as:
+        week (int8): Week of the calendar year e.g. 5
+        dayofweek (category): Short version of day of week e.g. Tue
+        weekend (category): Either "weekday" or "weekend" where weekends are where dayofweek is either "Sat" or "Sun"
+        hour (int8): Hour of the day in 24 clock e.g. 14
+        minute (int8): Minute of the hour e.g. 42
+        degrees (int16): Angle around 24 hour clock-face measured in degrees, calculated using hours and minutes
+        season (category): Season of the year defined as:
                         "Winter" where month is either "December", "January" or "February"
                         "Spring" where month is either "March", "April" or "May"
                         "Summer" where month is either "June", "July" or "August"
                         "Autumn" where month is either "September", "October" or "November"
+        The integer columns use the narrowest type that fits their values, so cast them to a wider type before
+        doing arithmetic that could overflow (e.g. hour * 60 + minute).
+
+    The datetime-related columns are cached for as long as the input DataFrame exists, so repeated calls on the same
+    DataFrame (e.g. when making several plots of it) only build them once. The cache is discarded if the values in
+    the datetime column or the index of the DataFrame change. The other columns are always taken from the DataFrame
+    as it is when called.
 
     Args:
         data (pandas.DataFrame): The DataFrame involved
         datetime_col (str): The column containing the datetime
         bins_per_day (int): The number of bins into which data will be aggregated (over a day).
                 This is useful when you have unequally spaced datetimes datatimes. (Defaults to 24)
+        needed (set, optional): The names of the columns to create, any names which aren't one of the columns
+                listed above are ignored. Defaults to None, in which case all columns are created.
+
+    Raises:
+        ValueError: When the datetime column contains missing values
 
     Returns:
         pandas.DataFrame: Copy of the input DataFrame with datetime-related columns added
     """
-    data = data_in.copy()
-    data[datetime_col] = pd.to_datetime(data[datetime_col])
-
-    data["year"] = data[datetime_col].dt.year
-    data["month"] = data[datetime_col].dt.strftime("%B")
-    data["year_month"] = data[datetime_col].dt.strftime("%Y%m").astype(int)
-    data["day"] = data[datetime_col].dt.day
-    data["date"] = data[datetime_col].dt.strftime("%Y-%m-%d")
-    data["week"] = data[datetime_col].dt.isocalendar().week
-    data["dayofweek"] = data[datetime_col].dt.strftime("%a")
-    data["weekend"] = "Weekday"
-    data.loc[(data["dayofweek"] == "Sat") | (data["dayofweek"] == "Sun"), "weekend"] = "Weekend"
-    data["hour"] = data[datetime_col].dt.hour
-    data["minute"] = data[datetime_col].dt.minute
-    data["degrees"] = 360 * data["hour"] / 24
-    # Temporarily keep this methodology, in the long-term this needs fixing to use the binning method for all
-    # circumstances
-    if bins_per_day != 24:
-        data["degrees"] = data["degrees"] + (360 * data["minute"] / (60 * 24))
-        data["degree_bins"] = pd.cut(data["degrees"], bins=bins_per_day)
-        data["degrees"] = data["degree_bins"].map(lambda x: x.mid).astype(int)
-
-    data["season"] = data["month"].map(
-        {
-            "December": "Winter",
-            "January": "Winter",
-            "February": "Winter",
-            "March": "Spring",
-            "April": "Spring",
-            "May": "Spring",
-            "June": "Summer",
-            "July": "Summer",
-            "August": "Summer",
-            "September": "Autumn",
-            "October": "Autumn",
-            "November": "Autumn",
+    needed = set(_DATETIME_COLS) if needed is None else set(needed) & set(_DATETIME_COLS)
+    cache_key = (id(data_in), datetime_col, bins_per_day)
+    cached = _DATETIME_VARS_CACHE.get(cache_key)
+    # Only reuse the cached columns if they were built from the same datetime values with the same index. The values
+    # are compared with Series.equals, which is much cheaper than rebuilding the columns (and doesn't need to convert
+    # tz-aware datetimes to Timestamp objects)
+    raw_datetimes = data_in[datetime_col]
+    if cached is None or cached["index"] is not data_in.index or not cached["source"].equals(raw_datetimes):
+        # Only parse the datetimes if they aren't already a datetime type, caching means repeated strings are parsed
+        # once
+        converted = None
+        if not pd.api.types.is_datetime64_any_dtype(raw_datetimes):
+            converted = pd.to_datetime(raw_datetimes, cache=True)
+        entry = {
+            # Keep a copy of the values, as the column may be modified in place after this call
+            "source": raw_datetimes.copy(),
+            "index": data_in.index,
+            "converted": converted,
+            "cols": pd.DataFrame(index=data_in.index),
         }
-    )
+    else:
+        entry = cached
+
+    # Build any of the needed columns that haven't been built already
+    missing_cols = {col for col in needed if col not in entry["cols"].columns}
+    if missing_cols:
+        datetimes = data_in[datetime_col] if entry["converted"] is None else entry["converted"]
+        new_cols = pd.DataFrame(_build_datetime_cols(datetimes, bins_per_day, missing_cols), index=data_in.index)
+        entry["cols"] = pd.concat([entry["cols"], new_cols], axis=1)
+    if cache_key not in _DATETIME_VARS_CACHE:
+        weakref.finalize(data_in, _DATETIME_VARS_CACHE.pop, cache_key, None)
+    _DATETIME_VARS_CACHE[cache_key] = entry
+
+    # Add the needed columns to the input as it is now, any of them already in the input (e.g. from a previous call)
+    # are replaced
+    new_cols = entry["cols"][[col for col in _DATETIME_COLS if col in needed]]
+    existing_cols = [col for col in new_cols.columns if col in data_in.columns]
+    data = data_in.drop(columns=existing_cols) if existing_cols else data_in
+    data = pd.concat([data, new_cols], axis=1)
+    if entry["converted"] is not None:
+        data[datetime_col] = entry["converted"]
 
     return data
 
 
+def _build_datetime_cols(datetimes: pd.Series, bins_per_day: int, needed: set) -> dict:
+    """Build the given datetime-related columns, see create_datetime_vars for their definitions
+
+    Args:
+        datetimes (pd.Series): The datetimes from which to build the columns
+        bins_per_day (int): The number of bins into which data will be aggregated (over a day)
+        needed (set): The names of the columns to build
+
+    Returns:
+        dict: The built columns as arrays, keyed by column name
+    """
+    # Missing datetimes can't be stored in the integer columns (and would otherwise be given a made up time of day)
+    if datetimes.isna().any():
+        raise ValueError(
+            "The datetime column contains missing values. Remove these rows before plotting, e.g. with dropna()"
+        )
+
+    # Use the integer datetime accessors rather than strftime, which formats each row in Python. The low cardinality
+    # string columns are built as categoricals directly from these integer codes. Only the accessors required by the
+    # needed columns are evaluated
+    if needed & {"year", "year_month"}:
+        year = datetimes.dt.year.to_numpy()
+    if needed & {"month", "year_month", "season"}:
+        month_i = datetimes.dt.month.to_numpy()
+    if needed & {"dayofweek", "weekend"}:
+        dow_i = datetimes.dt.dayofweek.to_numpy()
+    if needed & {"date", "hour", "minute", "degrees"}:
+        # Dates and times are taken from the local wall-clock time, so strip any timezone before converting to numpy
+        wall_clock = datetimes
+        if wall_clock.dt.tz is not None:
+            wall_clock = wall_clock.dt.tz_localize(None)
+        wall_clock = wall_clock.to_numpy(dtype="datetime64[s]")
+    if needed & {"hour", "minute", "degrees"}:
+        # Work out the time of day from the raw seconds, rather than going through the slower hour/minute accessors
+        seconds_in_day = wall_clock.view("i8") % 86400
+
+    # Collect the new columns and add them in one go, rather than inserting them into a copy one at a time. The
+    # numeric columns use the narrowest integer type that fits their range to keep the DataFrame small
+    new_cols = {}
+    if "year" in needed:
+        new_cols["year"] = year.astype(np.int16)
+    if "month" in needed:
+        new_cols["month"] = pd.Categorical.from_codes(month_i - 1, categories=_MONTH_NAMES)
+    if "year_month" in needed:
+        new_cols["year_month"] = year.astype(np.int32) * 100 + month_i
+    if "day" in needed:
+        new_cols["day"] = datetimes.dt.day.to_numpy().astype(np.int8)
+    if "date" in needed:
+        new_cols["date"] = wall_clock.astype("datetime64[D]").astype(str)
+    if "week" in needed:
+        new_cols["week"] = datetimes.dt.isocalendar().week.to_numpy().astype(np.int8)
+    if "dayofweek" in needed:
+        new_cols["dayofweek"] = pd.Categorical.from_codes(dow_i, categories=_DAY_NAMES)
+    if "weekend" in needed:
+        new_cols["weekend"] = pd.Categorical.from_codes((dow_i >= 5).astype(np.int8), categories=_WEEKEND_NAMES)
+    if "hour" in needed:
+        new_cols["hour"] = (seconds_in_day // 3600).astype(np.int8)
+    if "minute" in needed:
+        new_cols["minute"] = ((seconds_in_day // 60) % 60).astype(np.int8)
+    if "degrees" in needed:
+        # Temporarily keep this methodology, in the long-term this needs fixing to use the binning method for all
+        # circumstances
+        if bins_per_day == 24:
+            new_cols["degrees"] = ((seconds_in_day // 3600) * (360 // 24)).astype(np.int16)
+        else:
+            degrees = (seconds_in_day // 60) * (360 / (60 * 24))
+            # Assign each time to an equal width bin around the clock face and take the bin's midpoint
+            step = 360 / bins_per_day
+            bin_idx = np.floor(degrees / step)
+            new_cols["degrees"] = (bin_idx * step + step / 2).astype(np.int16)
+    if "season" in needed:
+        new_cols["season"] = pd.Categorical.from_codes(_SEASON_CODES[month_i], categories=_SEASON_NAMES)
+
+    return new_cols
+
+
 def default_category_orders() -> dict:
     """Returns the default dictionary of category orders"""
-    day_order = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-    weekend_order = ["Weekday", "Weekend"]
-    season_order = ["Spring", "Summer", "Autumn", "Winter"]
-    month_order = [
-        "January",
-        "February",
-        "March",
-        "April",
-        "May",
-        "June",
-        "July",
-        "August",
-        "September",
-        "October",
-        "November",
-        "December",
-    ]
-
-    category_orders = {
-        "dayofweek": day_order,
-        "weekend": weekend_order,
-        "season": season_order,
-        "month": month_order,
-    }
-
-    return category_orders
+    # Return a fresh copy so that callers can modify it without affecting the defaults
+    return {col: list(order) for col, order in _DEFAULT_CATEGORY_ORDERS.items()}
 
 
 def create_title(title_start: str, filters: dict, line_group: str):
@@ -191,30 +307,40 @@ def filter_and_group_data(
 
     # If columns have been specified that don't exist (or bins_per_day is manually specified) then
     # generate the datatime vars to see if that helps
-    if not set(relevant_cols).issubset(data.columns) or bins_per_day or len(relevant_cols) == 0:
-        data = create_datetime_vars(data, datetime_col, bins_per_day)
+    data_cols = set(data.columns)
+    missing_cols = [col for col in relevant_cols if col not in data_cols]
+    if missing_cols or bins_per_day or len(relevant_cols) == 0:
+        # Only create the columns that are missing (plus degrees if it needs re-binning)
+        needed = set(missing_cols)
+        if bins_per_day:
+            needed.add("degrees")
+        data = create_datetime_vars(data, datetime_col, bins_per_day, needed)
+        data_cols = set(data.columns)
+        missing_cols = [col for col in missing_cols if col not in data_cols]
     # If there are still missing columns raise an Exception
-    if not set(relevant_cols).issubset(data.columns):
-        missing_cols = [col for col in relevant_cols if col not in data.columns]
+    if missing_cols:
         raise KeyError(f"The following columns are missing from the supplied dataset: {missing_cols}")
 
     filtered_data = data
     if len(filters) > 0:
-        # Apply all the specified filters
+        # Combine all the specified filters into a single mask so the data is only subset once
+        mask = np.ones(len(data), dtype=bool)
         for col, val in filters.items():
-            # Note that the check that col is in filtered_data.columns has already been done above
+            # Note that the check that col is in data.columns has already been done above
             if col is not None:
-                if type(val) is list:
-                    filtered_data = filtered_data[filtered_data[col].isin(val)]
-                else:
-                    filtered_data = filtered_data[filtered_data[col] == val]
+                vals = val if type(val) is list else [val]
+                mask &= data[col].isin(vals).to_numpy()
+        filtered_data = data[mask]
 
         if len(filtered_data) == 0:
             raise Exception("Filtering data leaves 0 rows remaining. Check the filters that have been specified")
 
-    # Group by the required columns (using the list comprehension to remove columns that are None)
+    # Group by the required columns (using the list comprehension to remove columns that are None). The result is
+    # kept sorted by the group keys as plotly assigns trace, legend and colour order from the row order
     grouped_data = (
-        filtered_data.groupby([col for col in [line_group, color, line_dash, "degrees"] if col])[value_col]
+        filtered_data.groupby([col for col in [line_group, color, line_dash, "degrees"] if col], observed=True)[
+            value_col
+        ]
         .agg(agg_fn)
         .reset_index()
     )
@@ -227,41 +353,52 @@ def filter_and_group_data(
     return filtered_data, grouped_data
 
 
-def spline_interp(grouped_data: pd.DataFrame, value_col: str, groups: list, grouped_columns: list) -> pd.DataFrame:
+def spline_interp(grouped_data: pd.DataFrame, value_col: str, grouped_columns: list) -> pd.DataFrame:
     """Perform spline interpolation on the given data
 
     Args:
         grouped_data (pd.DataFrame): The data to interpolate
         value_col (str): The column name holding the values to be interpolated
-        groups (list): The groups of values on which the data will be separated for interpolartion
-        grouped_columns (list): The column names that were used for grouping the data
+        grouped_columns (list): The column names that were used for grouping the data, the data is separated
+                                into these groups for interpolation
 
     Returns:
         pd.DataFrame: The interpolated data
     """
-    interp_data = pd.DataFrame()
-    for values in groups:
-        filt = (grouped_data[grouped_columns] == values).all(axis=1)
-        df = grouped_data[filt].copy()
-        # It only makes sense to interpolate if we have enough data, here we choose 8 points (i.e. 3 hour intervals)
-        if len(df) >= 8:
-            # Want to put first values at end and last values at start to use for interpolation
-            # We use 3 values as we are doing a cublic spline. This is the minimum needed for good interpolation
-            # around 0-360 deg.
-            start = range(0, 3)
-            end = range(-3, 0)
-            df = pd.concat([pd.DataFrame(df.iloc[end, :]), df, pd.DataFrame(df.iloc[start, :])], axis=0)
-            df.iloc[end, df.columns == "degrees"] = df.iloc[end]["degrees"] + 360
-            df.iloc[start, df.columns == "degrees"] = df.iloc[start]["degrees"] - 360
-            # Reindex so we have rows for every degree value (plus the original rows)
-            new_index = np.linspace(0, 360, 361)
-            df = df.set_index("degrees")
-            df = df.reindex(df.index.union(new_index))
-            df[grouped_columns] = values
-            df[value_col] = df[value_col].astype(float).interpolate(method="cubicspline")
-            df.reset_index(inplace=True)
-            df = df.loc[(df["degrees"] >= 0) & (df["degrees"] < 360)]
-            interp_data = pd.concat([interp_data, df])
+    new_degrees = np.arange(0, 360, 1.0)
+    # Missing values can't be used as knots
+    data = grouped_data[grouped_data[value_col].notna()]
+    # Sort once so that each group's knots are contiguous and in increasing order of degrees, then find where each
+    # group starts. This avoids splitting the data into a DataFrame per group
+    group_ids = data.groupby(grouped_columns, observed=True, sort=False).ngroup().to_numpy()
+    degrees = data["degrees"].to_numpy(dtype=float)
+    order = np.lexsort((degrees, group_ids))
+    group_ids = group_ids[order]
+    degrees = degrees[order]
+    values = data[value_col].to_numpy(dtype=float)[order]
+    starts = np.flatnonzero(np.diff(group_ids, prepend=-1))
+    ends = np.append(starts[1:], len(group_ids))
+    # It only makes sense to interpolate if we have enough data, here we choose 8 points (i.e. 3 hour intervals)
+    enough_data = ends - starts >= 8
+    starts, ends = starts[enough_data], ends[enough_data]
+    if len(starts) == 0:
+        return pd.DataFrame()
+
+    # Evaluate the splines at every degree value, giving one row of values per group
+    interp_values = np.empty((len(starts), len(new_degrees)))
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        x = degrees[start:end]
+        y = values[start:end]
+        # The line wraps around the clock, so fit a periodic spline. This needs a closing knot one full turn
+        # after the first
+        spline = scipy.interpolate.CubicSpline(np.append(x, x[0] + 360), np.append(y, y[0]), bc_type="periodic")
+        interp_values[i] = spline(new_degrees)
+
+    # Assemble the result for all groups at once, repeating each group's values of the grouped columns for every
+    # degree value
+    interp_data = data[grouped_columns].iloc[np.repeat(order[starts], len(new_degrees))].reset_index(drop=True)
+    interp_data["degrees"] = np.tile(new_degrees, len(starts))
+    interp_data[value_col] = interp_values.ravel()
 
     return interp_data
 
@@ -301,14 +438,16 @@ def plot_averages(
     """
     agg_col = list(aggregate.keys())[0]
     agg_fn = list(aggregate.values())[0]
-    agg_data = data.groupby([agg_col, "degrees"])[value_col].agg(agg_fn).reset_index()
+    agg_data = data.groupby([agg_col, "degrees"], observed=True)[value_col].agg(agg_fn).reset_index()
     # Want to change the data labels to reflect that it is aggregated ( This appears in the legend )
     agg_data[agg_col] = agg_data[agg_col].map(("{} (" + agg_fn + ")").format)
     # Also need to add these categories to the category_orders dict ( So the color and legend order are consistent)
+    # (Build a new dict rather than modifying the one passed in, which may be the shared default)
     if agg_col in category_orders:
-        category_orders[agg_col] = category_orders[agg_col] + [
-            f"{value} ({agg_fn})" for value in category_orders[agg_col]
-        ]
+        category_orders = {
+            **category_orders,
+            agg_col: list(category_orders[agg_col]) + [f"{value} ({agg_fn})" for value in category_orders[agg_col]],
+        }
 
     if mode == "polar":
         agg_fig = px.line_polar(
@@ -426,13 +565,12 @@ def clock_plot(
     orig_line_shape = line_shape
     columns = [col for col in [color, line_group, line_dash] if col]
     if len(columns) > 0:
-        groups = list(filtered_data.groupby(columns).groups.keys())
+        grp_length = len(filtered_data[columns].dropna().drop_duplicates())
     else:
-        groups = []
-    grp_length = len(groups)
+        grp_length = 0
     if grp_length > 20 and line_shape == "spline":
         line_shape = "linear"
-        grouped_data = spline_interp(grouped_data, value_col, groups, columns)
+        grouped_data = spline_interp(grouped_data, value_col, columns)
 
     tick_text = list(range(0, 24))
     if text_noon: